@@ -3,9 +3,16 @@
 import sys
 import pandas as pd
 import numpy as np
+from scipy import sparse
+from threadpoolctl import threadpool_limits
 from os import path
-from picrust2.util import (read_seqabun, make_output_dir, check_files_exist,
-                           three_df_index_overlap_sort)
+from picrust2.util import (read_seqabun_csc, read_predicted_table,
+                           make_output_dir, check_files_exist,
+                           index_overlap_sort)
+
+# Maximum size of each block of the stratified function x sequence x sample
+# array that is computed at once when the wide table is streamed to a file.
+STRAT_BLOCK_BYTES = 64 * 1024 * 1024
 
 
 def run_metagenome_pipeline(input_seqabun,
@@ -17,10 +24,17 @@ def run_metagenome_pipeline(input_seqabun,
                             strat_out=False,
                             wide_table=False,
                             skip_norm=False,
+                            proc=1,
+                            output_format='tsv',
+                            gpu=False,
                             out_dir='metagenome_out'):
     '''Main function to run full metagenome pipeline. Meant to run modular
     functions largely listed below. Will return predicted metagenomes
-    straitifed and unstratified by contributing genomes (i.e. taxa).'''
+    straitifed and unstratified by contributing genomes (i.e. taxa). The
+    exception is when a wide-format stratified table is output in parquet
+    format: this table is written directly to the output folder in blocks
+    and is not returned. The matrix products will be run on a GPU with CuPy
+    if gpu is True and a GPU is available.'''
 
     if not marker and not skip_norm:
         sys.exit("Table of predicted marker gene copy numbers is required "
@@ -31,13 +45,17 @@ def run_metagenome_pipeline(input_seqabun,
 
     make_output_dir(out_dir)
 
+    if gpu:
+        gpu = check_gpu_available()
+
     # Initialize empty pandas dataframe to contain NSTI values.
     nsti_val = pd.DataFrame()
 
-    study_seq_counts = read_seqabun(input_seqabun)
+    # Sequence abundances are kept as a sparse matrix, since most sequences
+    # are absent from most samples.
+    study_seq_counts, seq_ids, sample_ids = read_seqabun_csc(input_seqabun)
 
-    pred_function = pd.read_csv(function, sep="\t", dtype={'sequence': str})
-    pred_function.set_index('sequence', drop=True, inplace=True)
+    pred_function = read_predicted_table(function)
 
     # If NSTI column present then remove all rows with value above specified
     # max value. Also, remove NSTI column (in both dataframes).
@@ -47,8 +65,7 @@ def run_metagenome_pipeline(input_seqabun,
                                                     max_nsti=max_nsti)
     if not skip_norm:
         check_files_exist([marker])
-        pred_marker = pd.read_csv(marker, sep="\t", dtype={'sequence': str})
-        pred_marker.set_index('sequence', drop=True, inplace=True)
+        pred_marker = read_predicted_table(marker)
 
         if 'metadata_NSTI' in pred_marker.columns:
             pred_marker, nsti_val = drop_tips_by_nsti(tab=pred_marker,
@@ -56,134 +73,444 @@ def run_metagenome_pipeline(input_seqabun,
                                                       max_nsti=max_nsti)
 
         # Re-order predicted abundance tables to be in same order as study seqs.
-        # Also, drop any sequence ids that don't overlap across all dataframes.
-        study_seq_counts, pred_function, pred_marker = three_df_index_overlap_sort(study_seq_counts,
-                                                                                   pred_function,
-                                                                                   pred_marker)
-        norm_output = path.join(out_dir, "seqtab_norm.tsv.gz")
+        # Also, drop any sequence ids that don't overlap across all tables.
+        label_overlap = index_overlap_sort(seq_ids, pred_function.index,
+                                           pred_marker.index)
 
-        # Normalize input study sequence abundances by predicted abundance of
-        # marker genes and output normalized table if specified.
-        study_seq_counts = norm_by_marker_copies(input_seq_counts=study_seq_counts,
-                                                 input_marker_num=pred_marker,
-                                                 norm_filename=norm_output)
+        pred_marker = pred_marker.iloc[pred_marker.index.get_indexer(label_overlap)]
     else:
         # Get intersecting rows between input files and sort.
-        label_overlap = pred_function.index.intersection(study_seq_counts.index).sort_values()
+        label_overlap = pred_function.index.intersection(seq_ids).sort_values()
 
         if len(label_overlap) == 0:
             sys.exit("No sequence ids overlap between both input files.")
 
-        pred_function = pred_function.reindex(label_overlap)
-        study_seq_counts = study_seq_counts.reindex(label_overlap)
+    # Subset all tables to the overlapping ids by gathering rows at integer
+    # positions, rather than re-indexing by label.
+    pred_function = pred_function.iloc[pred_function.index.get_indexer(label_overlap)]
+    study_seq_counts = study_seq_counts[seq_ids.get_indexer(label_overlap)]
+    seq_ids = label_overlap
+
+    # Predicted copy numbers are usually small non-negative integers, so they
+    # can be stored with a more compact data type.
+    pred_function = downcast_copy_numbers(pred_function)
+
+    if not skip_norm:
+        marker_copies = pred_marker.to_numpy(dtype=np.float64)[:, 0]
+
+        norm_output = path.join(out_dir, "seqtab_norm.tsv.gz")
+
+        # Normalize input study sequence abundances by predicted abundance of
+        # marker genes and output normalized table if specified.
+        norm_seq_counts = norm_by_marker_copies(input_seq_counts=pd.DataFrame(study_seq_counts.toarray(),
+                                                                              index=seq_ids,
+                                                                              columns=sample_ids),
+                                                input_marker_num=pred_marker,
+                                                norm_filename=norm_output)
+
+        # Divide the function table by the marker copies instead, so that the
+        # unstratified table can be computed directly from the raw counts in
+        # a single matrix multiplication. The function table is typically
+        # much smaller than the sequence abundance table.
+        scaled_function = pd.DataFrame(pred_function.to_numpy(dtype=np.float64) /
+                                       marker_copies[:, None],
+                                       index=pred_function.index,
+                                       columns=pred_function.columns)
+    else:
+        marker_copies = np.ones(len(seq_ids), dtype=np.float64)
+
+        scaled_function = pred_function.astype(np.float64)
+
+        # A dense table is only needed for the NSTI and stratified outputs.
+        if strat_out or not nsti_val.empty:
+            norm_seq_counts = pd.DataFrame(study_seq_counts.toarray(),
+                                           index=seq_ids, columns=sample_ids)
 
     # If NSTI column input then output weighted NSTI values.
     if not nsti_val.empty:
         weighted_nsti_out = path.join(out_dir, "weighted_nsti.tsv.gz")
-        calc_weighted_nsti(seq_counts=study_seq_counts,
+        calc_weighted_nsti(seq_counts=norm_seq_counts,
                            nsti_input=nsti_val,
                            outfile=weighted_nsti_out)
 
     # Determine which sequences should be in the "RARE" category if stratified
-    # table is specified.
+    # table is specified. This is based on the normalized abundances, which
+    # are kept sparse for this step.
     if strat_out:
-        rare_seqs = []
+        rare_rows = None
 
         if min_reads != 1 or min_samples != 1:
-            rare_seqs = id_rare_seqs(in_counts=study_seq_counts,
+            rare_rows = id_rare_seqs(in_counts=sparse.diags(1 / marker_copies) @ study_seq_counts,
                                      min_reads=min_reads,
-                                     min_samples=min_samples)
+                                     min_samples=min_samples,
+                                     seq_ids=seq_ids)
+
+    # The unstratified table is computed in double precision. Only the
+    # predicted tables are stored compactly, since summing the products of
+    # large read counts in single precision loses too much accuracy.
+    study_seq_counts = study_seq_counts.astype(np.float64)
+
+    # Generate and return final tables. The number of threads used for the
+    # matrix products is limited to the number of processes specified.
+    with threadpool_limits(limits=proc):
+
+        if not strat_out:
+            return(None, unstrat_funcs_only_by_samples(scaled_function,
+                                                       study_seq_counts,
+                                                       sample_ids=sample_ids,
+                                                       gpu=gpu))
+
+        elif strat_out and not wide_table:
+            return(metagenome_contributions(pred_function, norm_seq_counts,
+                                            rare_rows),
+                   unstrat_funcs_only_by_samples(scaled_function,
+                                                 study_seq_counts,
+                                                 sample_ids=sample_ids,
+                                                 gpu=gpu))
+
+        elif strat_out and wide_table and output_format == 'parquet':
+            strat_outfile = path.join(out_dir, "pred_metagenome_strat.parquet")
+            return(None, write_strat_funcs_by_samples(pred_function,
+                                                      norm_seq_counts,
+                                                      strat_outfile,
+                                                      rare_rows,
+                                                      gpu=gpu))
+
+        elif strat_out and wide_table:
+            return(strat_funcs_by_samples(pred_function, norm_seq_counts,
+                                          rare_rows, gpu=gpu))
+
+
+def downcast_copy_numbers(tab):
+    '''Return table of predicted copy numbers as unsigned 16-bit integers if
+    all columns are integers with values that fit in this type. Otherwise
+    (e.g. for non-integer predictions) the table is returned unchanged.'''
+
+    if tab.size == 0 or \
+            not all(np.issubdtype(col_type, np.integer) for col_type in tab.dtypes):
+        return(tab)
+
+    tab_array = tab.to_numpy()
+
+    if tab_array.min() >= 0 and tab_array.max() <= np.iinfo(np.uint16).max:
+        return(tab.astype(np.uint16))
+    else:
+        return(tab)
+
+
+def check_gpu_available():
+    '''Returns True if CuPy can be imported and at least one GPU is visible.
+    Otherwise prints a warning that the CPU will be used instead and returns
+    False.'''
+
+    try:
+        import cupy
+        num_gpus = cupy.cuda.runtime.getDeviceCount()
+    except Exception:
+        num_gpus = 0
+
+    if num_gpus == 0:
+        print("Warning: --gpu was specified, but CuPy could not be imported "
+              "or no GPU was found. The CPU will be used instead.",
+              file=sys.stderr)
+        return(False)
+
+    return(True)
 
-    # Generate and return final tables.
-    if not strat_out:
-        return(None, unstrat_funcs_only_by_samples(pred_function,
-                                                   study_seq_counts))
 
-    elif strat_out and not wide_table:
-        return(metagenome_contributions(pred_function, study_seq_counts,
-                                        rare_seqs),
-               unstrat_funcs_only_by_samples(pred_function, study_seq_counts))
+def strat_block_size(func_array, sample_array, max_bytes=None):
+    '''Returns the number of sequences (i.e. rows of the function and
+    sequence abundance arrays) for which the function x sequence x sample
+    array of abundances fits in the specified number of bytes (or 1 if even
+    a single sequence does not fit). The number of bytes is
+    STRAT_BLOCK_BYTES unless specified.'''
 
-    elif strat_out and wide_table:
-        return(strat_funcs_by_samples(pred_function, study_seq_counts,
-                                      rare_seqs))
+    if max_bytes is None:
+        max_bytes = STRAT_BLOCK_BYTES
 
+    dtype_bytes = np.result_type(func_array, sample_array).itemsize
 
-def strat_funcs_by_samples(func_abun, sample_abun, rare_seqs=[],
-                           return_unstrat=True):
+    return(max(1, max_bytes // (dtype_bytes * func_array.shape[1] *
+                                sample_array.shape[1])))
+
+
+def strat_tensor(func_array, sample_array, gpu=False):
+    '''Takes in arrays of function and sequence abundances with rows in the
+    same order and returns the function x sequence x sample array of
+    abundances. This is computed with CuPy if gpu is True, in which case
+    blocks of sequences are copied to the GPU and back one at a time.'''
+
+    if gpu:
+        import cupy
+
+        strat_array = np.empty((func_array.shape[1], func_array.shape[0],
+                                sample_array.shape[1]),
+                               dtype=np.result_type(func_array, sample_array))
+
+        # Device memory is usually much smaller than host memory, so each
+        # block of the stratified array is limited to a quarter of the free
+        # device memory.
+        block_size = strat_block_size(func_array, sample_array,
+                                      max_bytes=cupy.cuda.runtime.memGetInfo()[0] // 4)
+
+        for block_start in range(0, func_array.shape[0], block_size):
+            block_rows = slice(block_start, block_start + block_size)
+
+            strat_array[:, block_rows, :] = cupy.asnumpy(cupy.einsum('sf,sn->fsn',
+                                                                     cupy.asarray(func_array[block_rows]),
+                                                                     cupy.asarray(sample_array[block_rows])))
+
+        return(strat_array)
+
+    return(np.einsum('sf,sn->fsn', func_array, sample_array, optimize=True))
+
+
+def strat_funcs_by_samples(func_abun, sample_abun, rare_rows=None,
+                           return_unstrat=True, gpu=False):
     '''Take in function table and study sequence abundance table. Returns
     stratified table of function abundances per sequence (rows) per samples
     (columns). Will also return unstratified format (function by sample).
-    Will collapse rare sequences into a single sequence category if
-    given a non-empty list of ids.'''
-
-    # Create combined stratified dataframe.
-    strat_func = pd.concat((sample_abun.multiply(func_abun[func], axis=0) for func in func_abun.columns),
-                           ignore_index=True, axis=0, sort=True)
+    Will collapse rare sequences into a single sequence category if given
+    a boolean array flagging these rows. Both input tables are expected to have
+    their rows (i.e. sequences) in the same order.'''
 
-    # Set multi-index labels to be sequence and function ids.
-    strat_func.index = pd.MultiIndex.from_product((func_abun.columns,
-                                                   func_abun.index))
-    strat_func.index.names = ['function', 'sequence']
+    func_ids = func_abun.columns
+    sample_ids = sample_abun.columns
 
-    if len(rare_seqs) > 0:
-        # Sum rare rows and make a new row named "RARE" in each df.
-        # Remove all the original rare rows.
+    func_array, sample_array, seq_ids, rare_array = collapse_rare_seqs(func_abun.to_numpy(),
+                                                                       sample_abun.to_numpy(),
+                                                                       func_abun.index,
+                                                                       rare_rows)
 
-        # First identify rows to remove, slice them out, and remove from original.
-        rare_seqs_rows = strat_func.index.get_level_values('sequence').isin(rare_seqs)
-        raw_seqs_slice = strat_func.iloc[rare_seqs_rows]
-        strat_func = strat_func.iloc[~rare_seqs_rows]
+    # Compute the full function x sequence x sample tensor of abundances in
+    # one step.
+    strat_array = strat_tensor(func_array, sample_array, gpu=gpu)
 
-        # Next remove sequence index and sum based on function id. Re-add "RARE"
-        # to be the sequence id.
-        raw_seqs_slice.index = raw_seqs_slice.index.droplevel('sequence')
-        raw_seqs_slice = raw_seqs_slice.sum(level=['function'])
-        raw_seqs_slice['sequence'] = 'RARE'
-        raw_seqs_slice.set_index('sequence', append=True, drop=True,
-                                 inplace=True)
+    strat_func = strat_array_to_df(strat_array, func_ids, seq_ids, sample_ids,
+                                   rare_array)
 
-        # Concat the RARE seqs to the full df.
-        strat_func = pd.concat([strat_func, raw_seqs_slice], axis=0, sort=True)
+    unstrat_array = strat_array.sum(axis=1)
 
-    # Remove rows that are all 0 and keep sample ids in same order.
-    strat_func = strat_func.loc[~(strat_func == 0).all(axis=1)]
+    if rare_array is not None:
+        unstrat_array += rare_array
 
-    strat_func = strat_func[list(sample_abun.columns)]
-
-    # Return dataframe and also unstratified dataframe if specified.
+    # Return dataframe and also unstratified dataframe (i.e. the sum over
+    # sequences) if specified.
     if return_unstrat:
-        return(strat_func, strat_func.groupby(level='function', axis=0).sum())
+        return(strat_func, unstrat_array_to_df(unstrat_array,
+                                               func_ids, sample_ids))
     else:
         return(strat_func)
 
 
-def unstrat_funcs_only_by_samples(func_abun, sample_abun):
-    '''Take in function table and study sequence abundance table. Returns
-    unstratified table of function abundances by samples.'''
+def write_strat_funcs_by_samples(func_abun, sample_abun, outfile,
+                                 rare_rows=None, block_size=None, gpu=False):
+    '''Same as strat_funcs_by_samples, except that the stratified table is
+    written to a parquet file in blocks of sequences rather than returned.
+    This means that only a single block of the stratified table is held in
+    memory at once. By default the number of sequences per block is chosen
+    so that each block of the stratified table takes up at most
+    STRAT_BLOCK_BYTES. Returns the unstratified table.'''
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    func_ids = func_abun.columns
+    sample_ids = sample_abun.columns
+
+    func_array, sample_array, seq_ids, rare_array = collapse_rare_seqs(func_abun.to_numpy(),
+                                                                       sample_abun.to_numpy(),
+                                                                       func_abun.index,
+                                                                       rare_rows)
+
+    value_dtype = np.result_type(func_array, sample_array)
+
+    if block_size is None:
+        block_size = strat_block_size(func_array, sample_array)
+
+    # Schema is set explicitly so that it is identical for every block.
+    strat_schema = pa.schema([('function', pa.string()),
+                              ('sequence', pa.string())] +
+                             [(sample, pa.from_numpy_dtype(value_dtype))
+                              for sample in sample_ids])
+
+    unstrat_array = np.zeros((len(func_ids), len(sample_ids)),
+                             dtype=value_dtype)
+
+    with pq.ParquetWriter(outfile, strat_schema,
+                          compression="zstd") as strat_writer:
+
+        def write_strat_block(strat_array, block_seq_ids):
+            strat_block = strat_array_to_arrow(strat_array, func_ids,
+                                               block_seq_ids, strat_schema)
 
-    # Sample ids are taken from sequence abundance table.
-    sample_ids = sample_abun.columns.values
+            if strat_block.num_rows > 0:
+                strat_writer.write_table(strat_block)
 
-    # List that will contain a series for each sample's unstratified
-    # function abundnaces.
-    sample_funcs = []
+        for block_start in range(0, len(seq_ids), block_size):
 
-    for sample in sample_ids:
-        sample_funcs.append(func_abun.mul(sample_abun[sample], axis=0).sum(axis=0))
+            block_rows = slice(block_start, block_start + block_size)
 
-    # Build dataframe from these series.
-    unstrat_func = pd.concat(sample_funcs, axis=1, sort=True)
+            strat_array = strat_tensor(func_array[block_rows],
+                                       sample_array[block_rows], gpu=gpu)
 
-    unstrat_func = unstrat_func.loc[~(unstrat_func == 0).all(axis=1)]
+            unstrat_array += strat_array.sum(axis=1)
 
-    unstrat_func.columns = sample_ids
+            write_strat_block(strat_array, seq_ids[block_rows])
+
+        # The "RARE" category is written as a final block.
+        if rare_array is not None:
+            unstrat_array += rare_array
+
+            write_strat_block(rare_array[:, None, :], pd.Index(['RARE']))
+
+    return(unstrat_array_to_df(unstrat_array, func_ids, sample_ids))
+
+
+def collapse_rare_seqs(func_array, sample_array, seq_ids, rare_rows):
+    '''Takes in arrays of function and sequence abundances, with rows in the
+    same order as the sequence ids, and a boolean array flagging which of
+    these rows are rare (or None). Returns both arrays and the ids subset to
+    sequences that are not rare, along with a function by sample array of
+    abundances contributed by all rare sequences (i.e. the "RARE" category).
+    This last array is None if there are no rare sequences.'''
+
+    if rare_rows is None or not rare_rows.any():
+        return(func_array, sample_array, seq_ids, None)
+
+    # Collapse rare sequences into a single "RARE" category before
+    # stratifying. The abundance of each function contributed by this
+    # category is the matrix product of the rare rows only, so the
+    # stratified tensor only needs to be computed for the remaining
+    # sequences.
+    rare_array = func_array[rare_rows].T @ sample_array[rare_rows]
+
+    return(func_array[~rare_rows], sample_array[~rare_rows],
+           seq_ids[~rare_rows], rare_array)
+
+
+def strat_array_nonzero(strat_array, num_seqs):
+    '''Reshape function x sequence x sample array of abundances to have a row
+    per function and sequence pair and remove rows that are all 0. Returns
+    these rows, along with the positions of each row's function and sequence
+    (i.e. integer codes for the labels of each row).'''
+
+    strat_array = strat_array.reshape(-1, strat_array.shape[2])
+
+    nonzero_rows = np.flatnonzero(strat_array.any(axis=1))
+
+    return(strat_array[nonzero_rows], nonzero_rows // num_seqs,
+           nonzero_rows % num_seqs)
+
+
+def strat_array_to_df(strat_array, func_ids, seq_ids, sample_ids,
+                      rare_array=None):
+    '''Reshape function x sequence x sample array of abundances into a
+    wide-format stratified table, with a row per function and sequence pair
+    (labelled by a multi-index) and a column per sample. Rows that are all 0
+    are removed. If a function by sample array of abundances for the "RARE"
+    category is given, then these rows are added after all other rows.'''
+
+    strat_values, func_codes, seq_codes = strat_array_nonzero(strat_array,
+                                                              len(seq_ids))
+
+    if rare_array is not None:
+        rare_values, rare_func_codes, _ = strat_array_nonzero(rare_array[:, None, :], 1)
+
+        strat_values = np.concatenate((strat_values, rare_values))
+        func_codes = np.concatenate((func_codes, rare_func_codes))
+        seq_codes = np.concatenate((seq_codes,
+                                    np.full(len(rare_func_codes),
+                                            len(seq_ids))))
+        seq_ids = seq_ids.append(pd.Index(['RARE']))
+
+    # Build multi-index from integer codes of the retained rows only. The
+    # levels are sorted (as they would be by MultiIndex.from_product), so
+    # the codes are mapped to the positions of the ids in the sorted levels.
+    func_order = func_ids.argsort()
+    seq_order = seq_ids.argsort()
+
+    strat_index = pd.MultiIndex(levels=[func_ids[func_order],
+                                        seq_ids[seq_order]],
+                                codes=[np.argsort(func_order)[func_codes],
+                                       np.argsort(seq_order)[seq_codes]],
+                                names=['function', 'sequence'])
+
+    return(pd.DataFrame(strat_values, index=strat_index, columns=sample_ids))
+
+
+def strat_array_to_arrow(strat_array, func_ids, seq_ids, strat_schema):
+    '''Same as strat_array_to_df, but returns a pyarrow table with the
+    function and sequence ids as the first two columns. The id columns are
+    gathered from the integer codes by pyarrow, so no Python string objects
+    are created per row.'''
+
+    import pyarrow as pa
+
+    strat_values, func_codes, seq_codes = strat_array_nonzero(strat_array,
+                                                              len(seq_ids))
+
+    # Transpose so that the values of each sample are contiguous.
+    strat_values = np.ascontiguousarray(strat_values.T)
+
+    return(pa.Table.from_arrays([pa.array(func_ids).take(func_codes),
+                                 pa.array(seq_ids).take(seq_codes)] +
+                                [pa.array(sample_values)
+                                 for sample_values in strat_values],
+                                schema=strat_schema))
+
+
+def unstrat_array_to_df(unstrat_array, func_ids, sample_ids):
+    '''Convert function by sample array of abundances into an unstratified
+    table, excluding functions that are absent from all samples.'''
+
+    nonzero_funcs = unstrat_array.any(axis=1)
+
+    unstrat_func = pd.DataFrame(unstrat_array[nonzero_funcs],
+                                index=func_ids[nonzero_funcs],
+                                columns=sample_ids)
+
+    unstrat_func.sort_index(inplace=True)
 
     unstrat_func.index.name = 'function'
 
     return(unstrat_func)
 
 
+def unstrat_funcs_only_by_samples(func_abun, sample_abun, sample_ids=None,
+                                  gpu=False):
+    '''Take in function table and study sequence abundance table. Returns
+    unstratified table of function abundances by samples. The sequence
+    abundances can also be a scipy sparse matrix with rows in the same order
+    as the function table, in which case the sample ids must be specified.
+    The product is computed with CuPy if gpu is True.'''
+
+    if sample_ids is None:
+        sample_ids = sample_abun.columns
+        sample_abun = sample_abun.to_numpy()
+
+    # Unstratified abundances are the product of the transposed function
+    # table with the sequence abundance table, which is computed as a single
+    # matrix multiplication rather than looping over samples. This is
+    # written as the transpose of (abundances^T x functions) so that sparse
+    # abundances are multiplied with the sparse matrix product.
+    if gpu:
+        import cupy
+        from cupyx.scipy import sparse as cupy_sparse
+
+        if sparse.issparse(sample_abun):
+            sample_abun_gpu = cupy_sparse.csr_matrix(sample_abun.T.tocsr())
+        else:
+            sample_abun_gpu = cupy.asarray(sample_abun.T)
+
+        unstrat_array = cupy.asnumpy((sample_abun_gpu @
+                                      cupy.asarray(func_abun.to_numpy())).T)
+    else:
+        unstrat_array = np.asarray((sample_abun.T @ func_abun.to_numpy()).T)
+
+    return(unstrat_array_to_df(unstrat_array, func_abun.columns, sample_ids))
+
+
 def drop_tips_by_nsti(tab, nsti_col, max_nsti):
     '''Takes in (1) function table (columns are functions, rows are predicted
     genomes for ASVs, (2) which column of this function table corresponds to
@@ -194,7 +521,12 @@ def drop_tips_by_nsti(tab, nsti_col, max_nsti):
 
     orig_num_rows = tab.shape[0]
 
-    tab = tab[tab[nsti_col] <= max_nsti]
+    # Rows are subset by position, which avoids building an intermediate
+    # boolean Series for the filter.
+    nsti_arr = tab[nsti_col].to_numpy()
+    keep = np.flatnonzero(nsti_arr <= max_nsti)
+
+    tab = tab.iloc[keep]
 
     filt_num_rows = tab.shape[0]
 
@@ -215,7 +547,7 @@ def drop_tips_by_nsti(tab, nsti_col, max_nsti):
 
     # Keep track of NSTI column as separate dataframe and remove this column
     # from the main dataframe.
-    nsti_val = tab[[nsti_col]]
+    nsti_val = pd.DataFrame({nsti_col: nsti_arr[keep]}, index=tab.index)
 
     return(tab.drop(nsti_col, axis=1, inplace=False), nsti_val)
 
@@ -225,12 +557,21 @@ def calc_weighted_nsti(seq_counts, nsti_input, outfile=None, return_df=False):
     value for each sequence. Will output these weighted values to a file if
     output file is specified. Will only return a df if specified.'''
 
-    nsti_mult = seq_counts.mul(nsti_input.metadata_NSTI, axis=0)
+    # Get NSTI values in the same order as the sequence counts (sequences
+    # without an NSTI value are given 0).
+    nsti_pos = nsti_input.index.get_indexer(seq_counts.index)
+    nsti_array = np.where(nsti_pos >= 0,
+                          nsti_input['metadata_NSTI'].to_numpy()[nsti_pos], 0)
 
-    # Get column sums divided by total abundance per sample.
-    weighted_nsti = pd.DataFrame(nsti_mult.sum(axis=0)/seq_counts.sum(axis=0))
+    seq_array = seq_counts.to_numpy()
 
-    weighted_nsti.columns = ["weighted_NSTI"]
+    # Get NSTI-weighted column sums (as a single vector-matrix product)
+    # divided by total abundance per sample.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weighted_nsti = pd.DataFrame((nsti_array @ seq_array) /
+                                     seq_array.sum(axis=0),
+                                     index=seq_counts.columns,
+                                     columns=["weighted_NSTI"])
 
     weighted_nsti.fillna(0, inplace=True)
 
@@ -249,53 +590,67 @@ def norm_by_marker_copies(input_seq_counts,
 
     '''Divides sequence counts (which correspond to amplicon sequence
     variants) by the predicted marker gene copies for each sequence. Will write
-    out the normalized table if option specified.'''
+    out the normalized table if option specified. Only the written table is
+    rounded; the returned table is left unrounded for downstream steps.'''
 
     input_seq_counts = input_seq_counts.div(input_marker_num.loc[
                                                 input_seq_counts.index.values,
                                                 input_marker_num.columns.values[0]],
                                             axis="index")
 
-    input_seq_counts = input_seq_counts.round(decimals=round_decimal)
-
     # Output normalized table if specified.
     if norm_filename:
-        input_seq_counts.to_csv(path_or_buf=norm_filename,
-                                index_label="normalized",
-                                sep="\t",
-                                compression="infer")
+        input_seq_counts.round(decimals=round_decimal).to_csv(path_or_buf=norm_filename,
+                                                              index_label="normalized",
+                                                              sep="\t",
+                                                              compression="infer")
 
     return(input_seq_counts)
 
 
-def id_rare_seqs(in_counts, min_reads, min_samples):
+def id_rare_seqs(in_counts, min_reads, min_samples, seq_ids=None):
     '''Determine which rows of a sequence countfile are below either the
-    cut-offs of min read counts or min samples present.'''
+    cut-offs of min read counts or min samples present. Returns a boolean
+    array that is True for these rows, in the same order as the input rows.
+    The counts can also be a scipy sparse matrix, in which case the sequence
+    ids (i.e. row labels) must be specified.'''
+
+    if seq_ids is None:
+        seq_ids = in_counts.index
+        in_counts = in_counts.to_numpy()
 
     # Check if "RARE" is the name of a sequence in this table.
-    if "RARE" in in_counts.index:
+    if "RARE" in seq_ids:
         sys.exit("Stopping: the sequence called \"RARE\" in the sequence " +
                  "abundance table should be re-named.")
 
-    low_freq_seq = set(in_counts[in_counts.sum(axis=1) < min_reads].index)
-    few_samples_seq = set(in_counts[(in_counts != 0).astype(int).sum(axis=1) < min_samples].index)
+    # Row sums and number of non-zero entries per row only need to touch
+    # the non-zero values of a sparse matrix.
+    in_counts = sparse.csr_matrix(in_counts)
+
+    low_freq_seq = in_counts.sum(axis=1).A1 < min_reads
+    few_samples_seq = (in_counts != 0).getnnz(axis=1) < min_samples
 
-    return(list(low_freq_seq.union(few_samples_seq)))
+    return(low_freq_seq | few_samples_seq)
 
 
-def metagenome_contributions(func_abun, sample_abun, rare_seqs=[],
+def metagenome_contributions(func_abun, sample_abun, rare_rows=None,
                              skip_abun=False):
     '''Take in function table and study sequence abundance table. Returns
     long-form table of how each sequence contributes functions in each
     sample. Note that the old format of columns (such as calling the sequences
     "OTUs" is retained here for backwards compatability. A subset of input
     sequences will be collapsed to a single category called "RARE" if a
-    non-empty list is input for the rare_seqs option. The skip_abun option
+    boolean array flagging these rows of the function table is input for
+    the rare_rows option. The skip_abun option
     can be set when the abundances columns are not needed.'''
 
     # Make copy of sample abundance that is in terms of relative abundances.
     sample_relabun = sample_abun.div(sample_abun.sum(axis=0), axis=1) * 100
 
+    if rare_rows is None:
+        rare_rows = np.zeros(func_abun.shape[0], dtype=bool)
+
     # Counter used to identify the first sample.
     s_i = 0
 
@@ -311,6 +666,7 @@ def metagenome_contributions(func_abun, sample_abun, rare_seqs=[],
         func_abun_subset = func_abun.loc[intersecting_taxa]
         single_abun = single_abun.loc[intersecting_taxa]
         single_relabun = single_relabun.loc[intersecting_taxa]
+        subset_rare_rows = rare_rows[func_abun.index.get_indexer(intersecting_taxa)]
 
         # Melt function table to be long format.
         func_abun_subset['taxon'] = func_abun_subset.index.to_list()
@@ -320,14 +676,21 @@ def metagenome_contributions(func_abun, sample_abun, rare_seqs=[],
                                         value_name='genome_function_count',
                                         var_name='function')
 
+        # Melted rows are ordered by function and then by taxon, so the
+        # position of each row's taxon in the subset is repeated per function.
+        taxon_pos = np.tile(np.arange(len(intersecting_taxa)),
+                            len(func_abun.columns))
+
         # Remove rows where gene count is 0.
-        func_abun_subset_melt = func_abun_subset_melt[func_abun_subset_melt['genome_function_count'] != 0]
+        nonzero_rows = (func_abun_subset_melt['genome_function_count'] != 0).to_numpy()
+        func_abun_subset_melt = func_abun_subset_melt[nonzero_rows]
+        taxon_pos = taxon_pos[nonzero_rows]
 
         if not skip_abun:
 
-            func_abun_subset_melt['taxon_abun'] = single_abun.loc[func_abun_subset_melt['taxon'].to_list()].to_list()
+            func_abun_subset_melt['taxon_abun'] = single_abun.to_numpy()[taxon_pos]
 
-            func_abun_subset_melt['taxon_rel_abun'] = single_relabun.loc[func_abun_subset_melt['taxon'].to_list()].to_list()
+            func_abun_subset_melt['taxon_rel_abun'] = single_relabun.to_numpy()[taxon_pos]
 
             func_abun_subset_melt['taxon_function_abun'] = func_abun_subset_melt['genome_function_count'] * func_abun_subset_melt['taxon_abun']
 
@@ -337,10 +700,10 @@ def metagenome_contributions(func_abun, sample_abun, rare_seqs=[],
                                                                    func_abun_subset_melt.groupby("function").sum(numeric_only=True)["taxon_function_abun"][func_abun_subset_melt["function"]].to_numpy()
 
         # Collapse sequences identified as "rare" to the same category.
-        rare_seqs = [r for r in rare_seqs if r in func_abun_subset_melt['taxon'].to_list()]
+        melt_rare_rows = subset_rare_rows[taxon_pos]
 
-        if len(rare_seqs) > 0:
-            func_abun_subset_melt.loc[func_abun_subset_melt['taxon'].isin(rare_seqs), 'taxon'] = 'RARE'
+        if melt_rare_rows.any():
+            func_abun_subset_melt.loc[melt_rare_rows, 'taxon'] = 'RARE'
             func_abun_subset_melt = func_abun_subset_melt.groupby(['function', 'taxon'],
                                                                   as_index=False).sum()
 
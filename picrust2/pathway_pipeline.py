@@ -798,7 +798,6 @@ def per_sequence_contrib_levels(sequence_abun, sequence_func,
     if wide_table:
         strat_abun = strat_funcs_by_samples(func_abun=path_abun_by_seq,
                                             sample_abun=study_seq_counts,
-                                            rare_seqs=[],
                                             return_unstrat=False)
 
         strat_abun.index.set_names("pathway", level=0, inplace=True)
@@ -806,8 +805,7 @@ def per_sequence_contrib_levels(sequence_abun, sequence_func,
         strat_abun.sort_values(['pathway', 'sequence'], inplace=True)
     else:
         strat_abun = metagenome_contributions(func_abun=path_abun_by_seq,
-                                              sample_abun=study_seq_counts,
-                                              rare_seqs=[])
+                                              sample_abun=study_seq_counts)
 
     if calc_coverage:
 
@@ -825,7 +823,6 @@ def per_sequence_contrib_levels(sequence_abun, sequence_func,
 
             strat_cov = strat_funcs_by_samples(func_abun=path_cov_by_seq,
                                                sample_abun=study_seq_counts,
-                                               rare_seqs=[],
                                                return_unstrat=False)
             strat_cov.index.set_names("pathway", level=0, inplace=True)
             strat_cov.reset_index(drop=False, inplace=True)
@@ -833,7 +830,6 @@ def per_sequence_contrib_levels(sequence_abun, sequence_func,
         else:
             strat_cov = metagenome_contributions(func_abun=path_cov_by_seq,
                                                  sample_abun=study_seq_counts,
-                                                 rare_seqs=[],
                                                  skip_abun=True)
     else:
         path_cov_by_seq = None
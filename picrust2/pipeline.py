@@ -222,6 +222,7 @@ def full_pipeline(study_fasta,
                                    "--function", predicted_funcs[func],
                                    "--min_reads", str(min_reads),
                                    "--min_samples", str(min_samples),
+                                   "--processes", str(processes),
                                    "--out_dir", func_output_dir]
 
         # Initialize two-element list as value for each function.
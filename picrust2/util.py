@@ -10,7 +10,7 @@ import weakref as _weakref
 import warnings as _warnings
 import pandas as pd
 import numpy as np
-import biom
+from scipy import sparse
 import tempfile
 import gzip
 import sys
@@ -328,8 +328,8 @@ def read_seqabun(infile):
     # as BIOM table and return. This is expected to be the most common input.
     in_name, in_ext = splitext(infile)
     if in_ext == ".biom":
+        import biom
         input_seqabun = biom.load_table(infile).to_dataframe(dense=True)
-        input_seqabun.index.astype('str', copy=False)
         kill_if_unnamed_col_in_seqabun(input_seqabun)
         return(input_seqabun)
 
@@ -355,7 +355,6 @@ def read_seqabun(infile):
         input_seqabun.set_index(keys="Group", drop=True, inplace=True)
         input_seqabun.index.name = None
         input_seqabun = input_seqabun.transpose()
-        input_seqabun.index.astype('str', copy=False)
         kill_if_unnamed_col_in_seqabun(input_seqabun)
         return(input_seqabun)
     else:
@@ -403,21 +402,84 @@ def read_seqabun(infile):
         return(input_seqabun)
 
 
-def three_df_index_overlap_sort(df1, df2, df3):
-    '''Given 3 pandas dataframes, will first determine which index labels
-    overlap across all dataframes and will subset the labels to this set and
-    then will sort the dataframes to be in the same order'''
+def biom_to_csc(infile):
+    '''Read in BIOM table of sequence abundances and return it as a sparse
+    scipy.sparse.csc_matrix (sequences as rows, samples as columns) without
+    converting to a dense table. The sequence and sample ids are also
+    returned.'''
+
+    import biom
+    input_biom = biom.load_table(infile)
+
+    seq_ids = pd.Index(input_biom.ids(axis='observation').astype(str))
+    sample_ids = pd.Index(input_biom.ids(axis='sample').astype(str))
+
+    return(sparse.csc_matrix(input_biom.matrix_data), seq_ids, sample_ids)
+
 
-    label_overlap = df1.index.intersection(df2.index.intersection(df3.index)).sort_values()
+def read_seqabun_csc(infile):
+    '''Same as read_seqabun, but will return the sequence abundances as a
+    sparse scipy.sparse.csc_matrix along with the sequence and sample ids.
+    BIOM tables are read in directly as sparse matrices.'''
+
+    if splitext(infile)[1] == ".biom":
+        return(biom_to_csc(infile))
+
+    input_seqabun = read_seqabun(infile)
+
+    return(sparse.csc_matrix(input_seqabun.to_numpy()),
+           input_seqabun.index, input_seqabun.columns)
+
+
+def read_predicted_table(infile):
+    '''Read in table of predicted gene family (or marker gene) copy numbers
+    per sequence, as output by hsp.py, and return it with the sequence ids as
+    the index. The multi-threaded pyarrow CSV reader will be used if pyarrow
+    is installed, since these tables can be very large.'''
+
+    try:
+        import pyarrow as pa
+        from pyarrow import csv as pa_csv
+    except ImportError:
+        pred_table = pd.read_csv(infile, sep="\t", dtype={'sequence': str})
+        pred_table.set_index('sequence', drop=True, inplace=True)
+        return(pred_table)
+
+    pred_table = pa_csv.read_csv(infile,
+                                 parse_options=pa_csv.ParseOptions(delimiter="\t"),
+                                 convert_options=pa_csv.ConvertOptions(column_types={'sequence': pa.string()}))
+
+    pred_table = pred_table.to_pandas()
+    pred_table.set_index('sequence', drop=True, inplace=True)
+
+    return(pred_table)
+
+
+def index_overlap_sort(index1, index2, index3):
+    '''Given 3 pandas index objects, will return the sorted labels that
+    overlap across all of them. Will throw an error if there are no
+    overlapping labels.'''
+
+    label_overlap = index1.intersection(index2.intersection(index3)).sort_values()
 
     # If there are no overlapping labels then throw error.
     if len(label_overlap) == 0:
         sys.exit("Stopping - no sequence ids overlap between all three of the input files.")
 
-    elif len(label_overlap) < len(df1.index) * 0.5:
+    elif len(label_overlap) < len(index1) * 0.5:
         print("Warning: fewer than half of the sequence ids overlap between "
               "the input files.", file=sys.stderr)
 
+    return(label_overlap)
+
+
+def three_df_index_overlap_sort(df1, df2, df3):
+    '''Given 3 pandas dataframes, will first determine which index labels
+    overlap across all dataframes and will subset the labels to this set and
+    then will sort the dataframes to be in the same order'''
+
+    label_overlap = index_overlap_sort(df1.index, df2.index, df3.index)
+
     df1 = df1.reindex(index=label_overlap)
     df2 = df2.reindex(index=label_overlap)
     df3 = df3.reindex(index=label_overlap)
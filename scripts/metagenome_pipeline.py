@@ -1,10 +1,9 @@
 #!/usr/bin/env python
 
 import argparse
+import sys
 from importlib.metadata import version
 from os import path
-from picrust2.metagenome_pipeline import run_metagenome_pipeline
-from picrust2.util import check_files_exist
 
 parser = argparse.ArgumentParser(
 
@@ -69,12 +68,33 @@ parser.add_argument('--wide_table', default=False, action='store_true',
                          '\"pred_metagenome_strat.tsv.gz\" when this option '
                          'is set.')
 
+parser.add_argument('--output_format', default='tsv', choices=['tsv', 'parquet'],
+                    help='File format of the stratified table output when '
+                         '\"--strat_out\" is set. Parquet files are '
+                         'compressed with zstd, are much faster to write and '
+                         'read for large tables and require the pyarrow '
+                         'Python package. The stratified outfile will have '
+                         'the extension \".parquet\" instead of '
+                         '\".tsv.gz\" when this is set to parquet. The '
+                         'unstratified table is always output in TSV format '
+                         '(default: %(default)s).')
+
 parser.add_argument('--skip_norm', default=False, action='store_true',
                     help='Skip normalizing sequence abundances by predicted '
                          'marker gene copy numbers (typically 16S rRNA '
                          'genes). This step will be performed automatically '
                          'unless this option is specified.')
 
+parser.add_argument('-p', '--processes', default=1, type=int,
+                    help='Number of threads to use for the matrix '
+                         'multiplications (default: %(default)d).')
+
+parser.add_argument('--gpu', default=False, action='store_true',
+                    help='Compute the matrix multiplications on a GPU. This '
+                         'requires the CuPy Python package and is only '
+                         'worthwhile for very large datasets. The CPU will '
+                         'be used instead if CuPy or a GPU is not available.')
+
 parser.add_argument('-o', '--out_dir', metavar='PATH', type=str,
                     default='metagenome_out',
                     help='Output directory for metagenome predictions. '
@@ -88,8 +108,20 @@ def main():
 
     args = parser.parse_args()
 
+    # Imported only once arguments are parsed, so that the help message is
+    # printed without loading pandas, scipy and biom.
+    from picrust2.metagenome_pipeline import run_metagenome_pipeline
+    from picrust2.util import check_files_exist
+
     check_files_exist([args.input, args.function])
 
+    if args.strat_out and args.output_format == "parquet":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            sys.exit("Stopping - the pyarrow Python package needs to be "
+                     "installed to use \"--output_format parquet\".")
+
     strat_pred, unstrat_pred = run_metagenome_pipeline(
                                             input_seqabun=args.input,
                                             function=args.function,
@@ -100,13 +132,25 @@ def main():
                                             min_samples=args.min_samples,
                                             strat_out=args.strat_out,
                                             wide_table=args.wide_table,
-                                            skip_norm=args.skip_norm)
+                                            skip_norm=args.skip_norm,
+                                            proc=args.processes,
+                                            output_format=args.output_format,
+                                            gpu=args.gpu)
 
     unstrat_outfile = path.join(args.out_dir, "pred_metagenome_unstrat.tsv.gz")
     unstrat_pred.to_csv(path_or_buf=unstrat_outfile, sep="\t", index=True,
                         index_label="function", compression="gzip")
 
-    if args.strat_out and not args.wide_table:
+    # Wide-format parquet tables are written by run_metagenome_pipeline
+    # directly, in blocks of sequences.
+    if args.strat_out and args.output_format == "parquet":
+        if not args.wide_table:
+            strat_outfile = path.join(args.out_dir,
+                                      "pred_metagenome_contrib.parquet")
+            strat_pred.to_parquet(strat_outfile, engine="pyarrow",
+                                  compression="zstd", index=False)
+
+    elif args.strat_out and not args.wide_table:
         strat_outfile = path.join(args.out_dir, "pred_metagenome_contrib.tsv.gz")
         strat_pred.to_csv(path_or_buf=strat_outfile, sep="\t", index=False,
                           compression="gzip")
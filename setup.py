@@ -22,7 +22,10 @@ setup(name='PICRUSt2',
       install_requires=['numpy',
 			'h5py',
                         'joblib',
+                        'scipy',
+                        'threadpoolctl',
                         'biom-format'],
+      extras_require={'parquet': ['pyarrow']},
       package_data={'picrust2':
                     ['MinPath/MinPath12hmp.py',
                      'Rscripts/*R']},
@@ -1,15 +1,34 @@
 #!/usr/bin/env python
 
 import unittest
+import runpy
+import sys
+import types
+import io
+from contextlib import redirect_stderr
+from unittest import mock
 from os import path
 import pandas as pd
+import numpy as np
 import biom
+from scipy import sparse
+from importlib.util import find_spec
 from picrust2.util import TemporaryDirectory
 from picrust2.metagenome_pipeline import (run_metagenome_pipeline,
                                           norm_by_marker_copies,
                                           calc_weighted_nsti,
                                           id_rare_seqs,
-                                          drop_tips_by_nsti)
+                                          drop_tips_by_nsti,
+                                          downcast_copy_numbers,
+                                          metagenome_contributions,
+                                          strat_funcs_by_samples,
+                                          strat_block_size,
+                                          strat_tensor,
+                                          check_gpu_available,
+                                          write_strat_funcs_by_samples)
+
+# pyarrow is optional, so the tests of parquet output are skipped without it.
+pyarrow_available = find_spec('pyarrow') is not None
 
 # Set paths to test files.
 test_dir_path = path.join(path.dirname(path.abspath(__file__)), "test_data",
@@ -50,6 +69,9 @@ exp_strat_simple_rare = path.join(test_dir_path, "metagenome_out",
 
 exp_norm = path.join(test_dir_path, "metagenome_out", "seqtab_norm.tsv.gz")
 
+metagenome_script = path.join(path.dirname(path.dirname(path.abspath(__file__))),
+                              "scripts", "metagenome_pipeline.py")
+
 # Read in test inputs and expected files.
 func_predict_in = pd.read_csv(func_predict, sep="\t", dtype={'sequence': str})
 func_predict_in.set_index('sequence', drop=True, inplace=True)
@@ -83,6 +105,15 @@ exp_norm_in.set_index('normalized', drop=True, inplace=True)
 nsti_in = pd.read_csv(nsti_in_path, sep="\t", dtype={'sequence': str})
 nsti_in.set_index('sequence', drop=True, inplace=True)
 
+# Sequence abundances and predicted functions for the same sequences in the
+# same order, along with which of these sequences are treated as rare.
+seqtab_aligned_in = biom.load_table(seqtab_biom).to_dataframe(dense=True)
+seqtab_aligned_in = seqtab_aligned_in.reindex(func_predict_in.index).dropna()
+func_aligned_in = func_predict_in.reindex(seqtab_aligned_in.index)
+
+rare_seqs_in = ["2558860574", "2571042244"]
+rare_rows_in = func_aligned_in.index.isin(rare_seqs_in)
+
 
 class metagenome_pipeline_test(unittest.TestCase):
 
@@ -100,7 +131,8 @@ class metagenome_pipeline_test(unittest.TestCase):
 
         pd.testing.assert_frame_equal(strat_out.reset_index(drop=True),
                                       exp_strat_simple_in.reset_index(drop=True),
-                                      check_like=True, atol=1e-3)
+                                      check_like=True, check_dtype=False,
+                                      atol=1e-3)
         pd.testing.assert_frame_equal(unstrat_out, exp_unstrat_simple_in,
                                       check_like=True, atol=1e-3)
 
@@ -119,7 +151,8 @@ class metagenome_pipeline_test(unittest.TestCase):
 
         pd.testing.assert_frame_equal(strat_out.reset_index(drop=True),
                                       exp_strat_simple_in.reset_index(drop=True),
-                                      check_like=True, atol=1e-3)
+                                      check_like=True, check_dtype=False,
+                                      atol=1e-3)
         pd.testing.assert_frame_equal(unstrat_out, exp_unstrat_simple_in,
                                       check_like=True, atol=1e-3)
 
@@ -218,6 +251,61 @@ class metagenome_pipeline_test(unittest.TestCase):
         pd.testing.assert_frame_equal(unstrat_out, exp_unstrat_in,
                                       check_like=True)
 
+    def test_full_pipeline_unstrat_large_counts(self):
+        '''Test that the unstratified table is accurate when sequence counts
+        are large, which requires the products to be summed in double
+        precision.'''
+
+        rng = np.random.default_rng(42)
+
+        seq_ids = ["seq" + str(i) for i in range(300)]
+        sample_ids = ["sample" + str(i) for i in range(5)]
+        func_ids = ["func" + str(i) for i in range(4)]
+
+        seqtab = pd.DataFrame(rng.integers(0, 200000, size=(300, 5)),
+                              index=seq_ids, columns=sample_ids)
+        func = pd.DataFrame(rng.integers(0, 20, size=(300, 4)),
+                            index=seq_ids, columns=func_ids)
+        marker = pd.DataFrame({'16S_rRNA_Count': rng.integers(1, 8, size=300)},
+                              index=seq_ids)
+
+        exp_unstrat = func.T @ seqtab.div(marker['16S_rRNA_Count'], axis=0)
+
+        with TemporaryDirectory() as temp_dir:
+            seqtab_path = path.join(temp_dir, "seqtab.tsv")
+            func_path = path.join(temp_dir, "func.tsv")
+            marker_path = path.join(temp_dir, "marker.tsv")
+
+            seqtab.to_csv(seqtab_path, sep="\t", index_label="seq")
+            func.to_csv(func_path, sep="\t", index_label="sequence")
+            marker.to_csv(marker_path, sep="\t", index_label="sequence")
+
+            strat_out, unstrat_out = run_metagenome_pipeline(input_seqabun=seqtab_path,
+                                                             function=func_path,
+                                                             marker=marker_path,
+                                                             max_nsti=2,
+                                                             out_dir=temp_dir,
+                                                             strat_out=False)
+
+        pd.testing.assert_frame_equal(unstrat_out, exp_unstrat,
+                                      check_like=True, check_names=False,
+                                      rtol=0, atol=1e-2)
+
+    def test_downcast_copy_numbers(self):
+        '''Test that predicted copy numbers are stored as uint16 only when all
+        columns are integers in range, and are unchanged otherwise.'''
+
+        in_tab = pd.DataFrame({'a': [0, 1, 5], 'b': [2, 0, 65535]})
+
+        self.assertTrue((downcast_copy_numbers(in_tab).dtypes == np.uint16).all())
+
+        for values in [[0, -1, 5], [0, 1, 65536], [0.5, 1, 2],
+                       [np.nan, 1, 2], [2.0, 0.0, 1.0]]:
+            in_tab = pd.DataFrame({'a': values})
+
+            pd.testing.assert_frame_equal(downcast_copy_numbers(in_tab),
+                                          in_tab)
+
     def test_norm_by_marker_copies(self):
         '''Test that expected normalized sequence abundance table generated.'''
 
@@ -299,9 +387,10 @@ class rare_seqs_test(unittest.TestCase):
 
         seqtab_in = biom.load_table(seqtab_biom).to_dataframe(dense=True)
 
-        rare_seqs = id_rare_seqs(seqtab_in, 4, 1)
+        rare_rows = id_rare_seqs(seqtab_in, 4, 1)
 
-        self.assertSetEqual(set(rare_seqs), set(["2558860574", "extra"]))
+        self.assertSetEqual(set(seqtab_in.index[rare_rows]),
+                            set(["2558860574", "extra"]))
 
     def test_rare_2_samp(self):
         '''Check that correct sequences are identified as rare when a cut-off
@@ -309,9 +398,87 @@ class rare_seqs_test(unittest.TestCase):
 
         seqtab_in = biom.load_table(seqtab_biom).to_dataframe(dense=True)
 
-        rare_seqs = id_rare_seqs(seqtab_in, 1, 2)
+        rare_rows = id_rare_seqs(seqtab_in, 1, 2)
+
+        self.assertSetEqual(set(seqtab_in.index[rare_rows]),
+                            set(["2558860574", "2571042244"]))
+
+    def test_rare_sparse(self):
+        '''Check that rare sequences identified from a sparse table are the
+        same as those identified from the equivalent dataframe.'''
+
+        counts = sparse.random(200, 30, density=0.1, format='csc',
+                               random_state=7) * 10
+        seq_ids = pd.Index(["seq" + str(i) for i in range(200)])
+
+        counts_df = pd.DataFrame(counts.toarray(), index=seq_ids)
+
+        exp_rare_rows = ((counts_df.sum(axis=1) < 5) |
+                         ((counts_df != 0).sum(axis=1) < 3)).to_numpy()
+
+        self.assertTrue(0 < exp_rare_rows.sum() < 200)
+
+        np.testing.assert_array_equal(id_rare_seqs(counts, 5, 3,
+                                                   seq_ids=seq_ids),
+                                      exp_rare_rows)
+
+        np.testing.assert_array_equal(id_rare_seqs(counts_df, 5, 3),
+                                      exp_rare_rows)
+
+    def test_contrib_rare_absent_from_earlier_sample(self):
+        '''Check that a rare sequence is collapsed into the "RARE" category
+        in every sample, including samples after one where it is absent.'''
+
+        func_in = pd.DataFrame({'func1': [1, 2, 3], 'func2': [0, 1, 1]},
+                               index=['seqA', 'seqB', 'seqC'])
 
-        self.assertSetEqual(set(rare_seqs), set(["2558860574", "2571042244"]))
+        seqtab_in = pd.DataFrame({'sample1': [10, 5, 0],
+                                  'sample2': [10, 0, 2],
+                                  'sample3': [4, 1, 3]},
+                                 index=['seqA', 'seqB', 'seqC'])
+
+        contrib_out = metagenome_contributions(func_in, seqtab_in,
+                                               np.array([False, True, True]))
+
+        taxa_by_sample = contrib_out.groupby('sample')['taxon'].apply(set)
+
+        self.assertDictEqual(taxa_by_sample.to_dict(),
+                             {'sample1': {'seqA', 'RARE'},
+                              'sample2': {'seqA', 'RARE'},
+                              'sample3': {'seqA', 'RARE'}})
+
+        sample3_rare = contrib_out[(contrib_out['sample'] == 'sample3') &
+                                   (contrib_out['taxon'] == 'RARE')]
+
+        self.assertListEqual(list(sample3_rare['taxon_function_abun']),
+                             [11, 4])
+
+    def test_strat_wide_rare_category(self):
+        '''Check that the "RARE" category of the wide-format stratified table
+        is the sum of the collapsed sequences.'''
+
+        strat_full, unstrat_full = strat_funcs_by_samples(func_aligned_in,
+                                                          seqtab_aligned_in)
+
+        strat_rare, unstrat_rare = strat_funcs_by_samples(func_aligned_in,
+                                                          seqtab_aligned_in,
+                                                          rare_rows_in)
+
+        exp_rare = strat_full[strat_full.index.get_level_values('sequence').isin(rare_seqs_in)]
+        exp_rare = exp_rare.groupby(level='function').sum()
+
+        # "RARE" rows should come after all other rows.
+        rare_pos = np.flatnonzero(strat_rare.index.get_level_values('sequence') == 'RARE')
+
+        self.assertListEqual(list(rare_pos),
+                             list(range(len(strat_rare) - len(rare_pos),
+                                        len(strat_rare))))
+
+        obs_rare = strat_rare.xs('RARE', level='sequence')
+
+        pd.testing.assert_frame_equal(obs_rare, exp_rare, check_like=True)
+
+        pd.testing.assert_frame_equal(unstrat_rare, unstrat_full)
 
     def test_full_pipeline_strat_rare_category_tsv(self):
         '''Test that run_metagenome_pipeline works on tsv input seqtab and when
@@ -330,11 +497,256 @@ class rare_seqs_test(unittest.TestCase):
 
         pd.testing.assert_frame_equal(strat_out.reset_index(drop=True),
                                       exp_strat_simple_rare_in.reset_index(drop=True),
-                                      check_like=True)
+                                      check_like=True, check_dtype=False)
 
         pd.testing.assert_frame_equal(unstrat_out, exp_unstrat_simple_in,
                                       check_like=True)
 
 
+class strat_blocks_test(unittest.TestCase):
+    '''Checks that the wide-format stratified table is computed and written
+    correctly in blocks of sequences.'''
+
+    @unittest.skipUnless(pyarrow_available, "pyarrow is not installed")
+    def test_strat_wide_parquet_blocks(self):
+        '''Check that the wide-format stratified table written to parquet in
+        blocks of sequences matches the table generated in memory.'''
+
+        exp_strat, exp_unstrat = strat_funcs_by_samples(func_aligned_in,
+                                                        seqtab_aligned_in,
+                                                        rare_rows_in)
+
+        with TemporaryDirectory() as temp_dir:
+            strat_outfile = path.join(temp_dir, "strat.parquet")
+
+            obs_unstrat = write_strat_funcs_by_samples(func_aligned_in,
+                                                       seqtab_aligned_in,
+                                                       strat_outfile,
+                                                       rare_rows_in,
+                                                       block_size=2)
+
+            obs_strat = pd.read_parquet(strat_outfile)
+
+        obs_strat.set_index(['function', 'sequence'], inplace=True)
+
+        pd.testing.assert_frame_equal(obs_strat.sort_index(),
+                                      exp_strat.sort_index())
+
+        pd.testing.assert_frame_equal(obs_unstrat, exp_unstrat)
+
+    def test_strat_block_size(self):
+        '''Check that the number of sequences per block is based on the size
+        of the function x sequence x sample block of abundances.'''
+
+        func_array = np.ones((100, 10), dtype=np.uint16)
+        sample_array = np.ones((100, 5), dtype=np.float32)
+
+        self.assertEqual(strat_block_size(func_array, sample_array,
+                                          max_bytes=2000), 10)
+
+        self.assertEqual(strat_block_size(func_array, sample_array,
+                                          max_bytes=100), 1)
+
+    @unittest.skipUnless(pyarrow_available, "pyarrow is not installed")
+    def test_strat_wide_parquet_default_blocks(self):
+        '''Check that the wide-format stratified table written to parquet with
+        the default block size matches the table generated in memory when
+        the table is split over several blocks.'''
+
+        import pyarrow.parquet as pq
+
+        exp_strat, exp_unstrat = strat_funcs_by_samples(func_aligned_in,
+                                                        seqtab_aligned_in,
+                                                        rare_rows_in)
+
+        bytes_per_seq = 8 * func_aligned_in.shape[1] * seqtab_aligned_in.shape[1]
+
+        with TemporaryDirectory() as temp_dir:
+            strat_outfile = path.join(temp_dir, "strat.parquet")
+
+            with mock.patch('picrust2.metagenome_pipeline.STRAT_BLOCK_BYTES',
+                            2 * bytes_per_seq):
+                obs_unstrat = write_strat_funcs_by_samples(func_aligned_in,
+                                                           seqtab_aligned_in,
+                                                           strat_outfile,
+                                                           rare_rows_in)
+
+            num_row_groups = pq.ParquetFile(strat_outfile).num_row_groups
+
+            obs_strat = pd.read_parquet(strat_outfile)
+
+        self.assertGreater(num_row_groups, 2)
+
+        obs_strat.set_index(['function', 'sequence'], inplace=True)
+
+        pd.testing.assert_frame_equal(obs_strat.sort_index(),
+                                      exp_strat.sort_index())
+
+        pd.testing.assert_frame_equal(obs_unstrat, exp_unstrat)
+
+
+def numpy_cupy_stub(free_bytes):
+    '''Returns modules to add to sys.modules in place of CuPy and cupyx,
+    which run on NumPy and scipy instead of a GPU. The number of einsum calls
+    is kept in the einsum_calls list of the cupy module.'''
+
+    cupy_stub = types.ModuleType('cupy')
+    cupy_stub.einsum_calls = []
+
+    def einsum(subscripts, *operands):
+        cupy_stub.einsum_calls.append(operands[0].shape[0])
+        return(np.einsum(subscripts, *operands))
+
+    cupy_stub.einsum = einsum
+    cupy_stub.asarray = np.asarray
+    cupy_stub.asnumpy = np.asarray
+    cupy_stub.cuda = types.SimpleNamespace(
+        runtime=types.SimpleNamespace(getDeviceCount=lambda: 1,
+                                      memGetInfo=lambda: (free_bytes,
+                                                          free_bytes)))
+
+    cupyx_scipy_stub = types.ModuleType('cupyx.scipy')
+    cupyx_scipy_stub.sparse = types.ModuleType('cupyx.scipy.sparse')
+    cupyx_scipy_stub.sparse.csr_matrix = sparse.csr_matrix
+
+    cupyx_stub = types.ModuleType('cupyx')
+    cupyx_stub.scipy = cupyx_scipy_stub
+
+    return({'cupy': cupy_stub, 'cupyx': cupyx_stub,
+            'cupyx.scipy': cupyx_scipy_stub,
+            'cupyx.scipy.sparse': cupyx_scipy_stub.sparse})
+
+
+class gpu_test(unittest.TestCase):
+    '''Checks the CuPy code paths with a stub of CuPy that runs on NumPy.'''
+
+    def test_gpu_unavailable_without_cupy(self):
+        '''Check that the GPU is reported as unavailable, with a warning, when
+        CuPy cannot be imported.'''
+
+        stderr_out = io.StringIO()
+
+        with mock.patch.dict(sys.modules, {'cupy': None}):
+            with redirect_stderr(stderr_out):
+                self.assertFalse(check_gpu_available())
+
+        self.assertIn("CPU will be used instead", stderr_out.getvalue())
+
+    def test_gpu_available_with_cupy(self):
+        '''Check that the GPU is reported as available without a warning when
+        CuPy finds a GPU.'''
+
+        stderr_out = io.StringIO()
+
+        with mock.patch.dict(sys.modules, numpy_cupy_stub(free_bytes=1024)):
+            with redirect_stderr(stderr_out):
+                self.assertTrue(check_gpu_available())
+
+        self.assertEqual(stderr_out.getvalue(), "")
+
+    def test_strat_tensor_gpu_blocks(self):
+        '''Check that the stratified array is computed in several blocks of
+        sequences on the GPU and matches the array computed on the CPU.'''
+
+        func_array = func_aligned_in.to_numpy()
+        sample_array = seqtab_aligned_in.to_numpy()
+
+        bytes_per_seq = 8 * func_array.shape[1] * sample_array.shape[1]
+        stub_modules = numpy_cupy_stub(free_bytes=4 * 2 * bytes_per_seq)
+
+        with mock.patch.dict(sys.modules, stub_modules):
+            obs_strat = strat_tensor(func_array, sample_array, gpu=True)
+
+        np.testing.assert_array_equal(obs_strat,
+                                      strat_tensor(func_array, sample_array))
+
+        exp_calls = [2] * (func_array.shape[0] // 2) + \
+            [1] * (func_array.shape[0] % 2)
+
+        self.assertListEqual(stub_modules['cupy'].einsum_calls, exp_calls)
+
+    def test_full_pipeline_gpu_stub(self):
+        '''Test that run_metagenome_pipeline gives the expected unstratified
+        and wide-format stratified tables when the CuPy code paths are used.'''
+
+        stub_modules = numpy_cupy_stub(free_bytes=1024 * 1024)
+
+        with TemporaryDirectory() as temp_dir:
+            with mock.patch.dict(sys.modules, stub_modules):
+                strat_out, unstrat_out = run_metagenome_pipeline(input_seqabun=seqtab_tsv,
+                                                                 function=func_predict,
+                                                                 marker=marker_predict,
+                                                                 max_nsti=1.9,
+                                                                 out_dir=temp_dir,
+                                                                 strat_out=True,
+                                                                 wide_table=True,
+                                                                 gpu=True)
+
+                _, unstrat_only_out = run_metagenome_pipeline(input_seqabun=seqtab_tsv,
+                                                              function=func_predict,
+                                                              marker=marker_predict,
+                                                              max_nsti=1.9,
+                                                              out_dir=temp_dir,
+                                                              gpu=True)
+
+        self.assertTrue(len(stub_modules['cupy'].einsum_calls) > 0)
+
+        pd.testing.assert_frame_equal(strat_out, exp_strat_wide_in,
+                                      check_like=True, check_dtype=False)
+
+        pd.testing.assert_frame_equal(unstrat_out, exp_unstrat_in,
+                                      check_like=True)
+
+        pd.testing.assert_frame_equal(unstrat_only_out, exp_unstrat_in,
+                                      check_like=True)
+
+
+class metagenome_script_test(unittest.TestCase):
+    '''Tests of the output files written by metagenome_pipeline.py.'''
+
+    def setUp(self):
+        self.script_main = runpy.run_path(metagenome_script)['main']
+
+    def run_script_main(self, args):
+        with mock.patch.object(sys, 'argv', ['metagenome_pipeline.py'] + args):
+            self.script_main()
+
+    @unittest.skipUnless(pyarrow_available, "pyarrow is not installed")
+    def test_contrib_parquet_output(self):
+        '''Test that the metagenome contribution table written in parquet
+        format matches the expected table.'''
+
+        with TemporaryDirectory() as temp_dir:
+            self.run_script_main(['-i', seqtab_tsv_simple,
+                                  '-f', func_simple_in,
+                                  '-m', marker_simple_in,
+                                  '--max_nsti', '1.9',
+                                  '--strat_out',
+                                  '--output_format', 'parquet',
+                                  '-o', temp_dir])
+
+            strat_out = pd.read_parquet(path.join(temp_dir,
+                                                  "pred_metagenome_contrib.parquet"))
+
+        pd.testing.assert_frame_equal(strat_out,
+                                      exp_strat_simple_in.reset_index(drop=True),
+                                      check_like=True, check_dtype=False,
+                                      atol=1e-3)
+
+    def test_parquet_output_without_pyarrow_err(self):
+        '''Test that error thrown when parquet output is specified and pyarrow
+        cannot be imported.'''
+
+        with TemporaryDirectory() as temp_dir:
+            with mock.patch.dict(sys.modules, {'pyarrow': None}):
+                with self.assertRaisesRegex(SystemExit, "pyarrow"):
+                    self.run_script_main(['-i', seqtab_tsv_simple,
+                                          '-f', func_simple_in,
+                                          '-m', marker_simple_in,
+                                          '--strat_out',
+                                          '--output_format', 'parquet',
+                                          '-o', temp_dir])
+
+
 if __name__ == '__main__':
     unittest.main()
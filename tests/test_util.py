@@ -16,6 +16,8 @@ from picrust2.util import (write_fasta,
                            convert_picrust2_to_humann2_merged,
                            contrib_to_legacy,
                            read_seqabun,
+                           read_seqabun_csc,
+                           read_predicted_table,
                            TemporaryDirectory)
 
 from picrust2.default import default_map
@@ -27,6 +29,8 @@ seqtab_biom = path.join(metagenome_pipeline_test_dir_path,
                         "test_input_sequence_abun.biom")
 seqtab_msf = path.join(metagenome_pipeline_test_dir_path,
                        "test_input_sequence_abun.msf")
+func_predict = path.join(metagenome_pipeline_test_dir_path,
+                         "test_predicted_func.tsv.gz")
 
 descrip_test_dir_path = path.join(path.dirname(path.abspath(__file__)),
                                   "test_data",
@@ -122,6 +126,30 @@ class util_test(unittest.TestCase):
         pd.testing.assert_frame_equal(seqtab_biom_in, seqtab_msf_in,
                                       check_dtype=False)
 
+    def test_seqabun_reading_sparse(self):
+        '''Test that BIOM tables read in as sparse matrices match the
+        dataframe version.'''
+
+        seqtab_sparse, seq_ids, sample_ids = read_seqabun_csc(seqtab_biom)
+
+        seqtab_sparse_df = pd.DataFrame(seqtab_sparse.toarray(),
+                                        index=seq_ids, columns=sample_ids)
+
+        pd.testing.assert_frame_equal(seqtab_sparse_df,
+                                      read_seqabun(seqtab_biom))
+
+    def test_predicted_table_reading(self):
+        '''Test that predicted copy number tables are read in with sequence
+        ids as the (string) index.'''
+
+        pred_in = read_predicted_table(func_predict)
+
+        exp_pred_in = pd.read_csv(func_predict, sep="\t",
+                                  dtype={'sequence': str})
+        exp_pred_in.set_index('sequence', drop=True, inplace=True)
+
+        pd.testing.assert_frame_equal(pred_in, exp_pred_in)
+
     def test_read_write_fasta(self):
         '''Basic test that FASTA files are read and written correctly.'''
 